@@ -4,28 +4,89 @@ Helper script for batch chdman jobs
 '''
 
 # imports
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+from functools import lru_cache
+from mmap import ACCESS_READ, mmap
 from pathlib import Path
-from subprocess import run
-import argparse
+from subprocess import PIPE, Popen, run
+from stat import S_ISDIR, S_ISREG
+from struct import unpack_from
+from threading import Lock
+from types import SimpleNamespace
+import json
+import os
+import re
+import shlex
+import sqlite3
+import sys
 
 # constants
-CHDMAN_COMPRESS_FORMATS = {'auto', 'cd', 'dvd', 'ld', 'raw'}
-DISC_IMAGE_EXTS = {'.cue', '.gdi', '.iso'}
+CHDMAN_COMPRESS_FORMATS = frozenset({'auto', 'cd', 'dvd', 'ld', 'raw'})
+CHD_EXTS = frozenset({'.chd'})
+DISC_IMAGE_EXTS = frozenset({'.cue', '.gdi', '.iso'})
 FORMAT_TO_EXT = {'cd':'.cue', 'dvd':'.iso', 'ld':'.avi', 'raw':'.raw'}
 TAG_TO_FORMAT = {'CHT2':'cd', 'DVD':'dvd'}
+CREATE_COMMANDS = {f:'create%s' % f for f in FORMAT_TO_EXT}
+EXTRACT_COMMANDS = {f:'extract%s' % f for f in FORMAT_TO_EXT}
+CHD_MAGIC = b'MComprHD'
+CHD_V5_HEADER_SIZE = 124
+CHD_METADATA_ENTRY_SIZE = 16
+CODEC_NAMES = {
+    'zlib':'Deflate', 'zstd':'Zstandard', 'lzma':'LZMA', 'huff':'Huffman', 'flac':'FLAC',
+    'cdzl':'CD Deflate', 'cdzs':'CD Zstandard', 'cdlz':'CD LZMA', 'cdfl':'CD FLAC', 'avhu':'A/V Huffman',
+}
+PIPE_BUFFER_SIZE = 65536
+DELETE_JOBS = 8
+POPEN_CLOSE_FDS = os.name != 'posix' # Python's own fds are non-inheritable on POSIX, so skip the fd-closing pass (lets subprocess use vfork/posix_spawn)
+INFO_LINE_RE = re.compile(rb'^[ \t]*([^:\r\n]+?)[ \t]*:[ \t]+([^\r\n]*?)[ \t]*\r?$', re.MULTILINE) # `Key:   Value` lines of `chdman.exe info` (split on the first colon)
+METADATA_TAG_RE = re.compile(rb"^Metadata:[ \t]+Tag='([^']*)'") # tag of a `Metadata:` line of `chdman.exe info`
+CUE_FILE_RE = re.compile(r'^\s*FILE\s+(?:"([^"]+)"|(\S+))', re.MULTILINE)
+DEFAULT_COMPRESS_JOBS = 1 # `chdman.exe create*` already uses every core (see `--numprocessors`), so running several at once just oversubscribes the CPU
+DEFAULT_DECOMPRESS_JOBS = max(1, (os.cpu_count() or 1) // 2) # `chdman.exe extract*` decompresses on a single thread
+DEFAULT_INFO_JOBS = os.cpu_count() or 1 # `chdman.exe info` is mostly waiting on I/O, so use all cores
 
-# find default chdman.exe path if it exists
-DEFAULT_CHDMAN_PATH = None
-tmp = sorted(Path(__file__).parent.glob('chdman*.exe'))
-if len(tmp) != 0:
-    DEFAULT_CHDMAN_PATH = tmp[-1].resolve()
+# lock to keep messages from parallel jobs from interleaving
+PRINT_LOCK = Lock()
+
+# find default chdman.exe path if it exists (only scans the script folder the first time it's needed)
+@lru_cache(maxsize=None)
+def _default_chdman_path():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    with os.scandir(script_dir) as it:
+        names = sorted(entry.name for entry in it if fnmatch(entry.name, 'chdman*.exe'))
+    if len(names) == 0:
+        return None
+    return str(Path(script_dir, names[-1]).resolve())
+
+# resolve `chdman_path` (None means the default) to a string once per run, instead of per chdman call
+def _chdman_path_str(chdman_path):
+    return _default_chdman_path() if chdman_path is None else os.fspath(chdman_path)
+
+# determine whether a path is a 'file' or 'dir' (or None if neither) with a single stat call
+def _path_type(path):
+    try:
+        mode = os.stat(path).st_mode
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    if S_ISREG(mode):
+        return 'file'
+    elif S_ISDIR(mode):
+        return 'dir'
+    return None
 
 # parse user arguments
 def parse_args():
+    import argparse # only imported when needed (the common `info -i X` case is parsed by `_parse_info_args_fast`)
+
     # set up program-level arguments
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('--chdman_path', required=False, type=str, default=DEFAULT_CHDMAN_PATH, help="Path to chdman.exe")
+    parser.add_argument('--chdman_path', required=False, type=str, default=_default_chdman_path(), help="Path to chdman.exe")
     parser.add_argument('--dryrun', action="store_true", help="Print Commands (instead of running)")
+    parser.add_argument('-q', '--quiet', action="store_true", help="Don't Print Commands Before Running Them")
+    parser.add_argument('--cache_file', required=False, type=str, default=None, help="SQLite Cache of Finished Jobs (to skip unchanged files on reruns)")
+    parser.add_argument('-j', '--jobs', required=False, type=int, default=argparse.SUPPRESS, help="Number of Parallel chdman Jobs (when input is a folder) (default: %d for compress, %d for decompress, %d for info)" % (DEFAULT_COMPRESS_JOBS, DEFAULT_DECOMPRESS_JOBS, DEFAULT_INFO_JOBS))
 
     # set up sub-parsers
     sub_parsers = parser.add_subparsers(dest='command', required=True)
@@ -50,216 +111,604 @@ def parse_args():
 
     # parse args and check for validity
     args = parser.parse_args()
+    if hasattr(args, 'format') and args.format not in CHDMAN_COMPRESS_FORMATS:
+        raise ValueError("Invalid output CHD format: %s" % args.format)
+    if not hasattr(args, 'jobs'):
+        args.jobs = {'compress':DEFAULT_COMPRESS_JOBS, 'decompress':DEFAULT_DECOMPRESS_JOBS, 'info':DEFAULT_INFO_JOBS}[args.command]
+    if args.jobs < 1:
+        raise ValueError("Number of jobs must be positive: %s" % args.jobs)
     if args.chdman_path is None:
         raise ValueError("Must specify chdman.exe path: --chdman_path")
-    else:
-        args.chdman_path = Path(args.chdman_path)
     if hasattr(args, 'input'):
         args.input = Path(args.input)
-        if not (args.input.is_file() or args.input.is_dir()):
+        args.input_type = _path_type(args.input)
+        if args.input_type is None:
             raise ValueError("Input path not found: %s" % args.input)
     if hasattr(args, 'output'):
         args.output = Path(args.output)
-        if args.output.is_file():
+        if _path_type(args.output) == 'file':
             raise ValueError("Output file exists: %s" % args.output)
     return args
 
+# parse the common `info -i X [-v]` command line without argparse (or None if it's anything else)
+def _parse_info_args_fast(argv):
+    if len(argv) not in {3, 4} or argv[0] != 'info':
+        return None
+    opts = argv[1:]
+    verbose = False
+    for flag in ('-v', '--verbose'):
+        if flag in opts:
+            opts.remove(flag)
+            verbose = True
+    if len(opts) != 2 or opts[0] not in {'-i', '--input'} or opts[1].startswith('-'):
+        return None
+    chdman_path = _default_chdman_path()
+    input_path = Path(opts[1])
+    input_type = _path_type(input_path)
+    if chdman_path is None or input_type is None:
+        return None # let `parse_args` report the error
+    return SimpleNamespace(
+        command='info', input=input_path, input_type=input_type, verbose=verbose, chdman_path=chdman_path,
+        dryrun=False, quiet=False, cache_file=None, jobs=DEFAULT_INFO_JOBS,
+    )
+
+# find all files under `root` with one of the extensions in `exts` (lowercase), walking with `os.scandir` to avoid extra stat calls
+def _iter_files(root, exts):
+    is_wanted_ext = exts.__contains__
+    stack = [str(root)]
+    while len(stack) != 0:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    else:
+                        name = entry.name
+                        dot = name.rfind('.')
+                        if dot != -1 and is_wanted_ext(name[dot:].lower()) and entry.is_file():
+                            yield Path(entry.path)
+        except PermissionError:
+            pass
+
+# get the chdman version from its banner (e.g. `chdman - MAME Compressed Hunks of Data (CHD) manager 0.272 (mame0272)`)
+def get_chdman_version(chdman_path=None):
+    chdman_path = _chdman_path_str(chdman_path)
+    proc = run([chdman_path], capture_output=True)
+    for line in proc.stdout.decode(errors='replace').splitlines():
+        if line.strip() != '':
+            return line.strip()
+    return None
+
+# SQLite cache of finished jobs, keyed by (absolute input path, size, mtime, chdman version)
+class JobCache:
+    def __init__(self, cache_path, chdman_version):
+        self.chdman_version = chdman_version
+        self.lock = Lock()
+        self.db = sqlite3.connect(cache_path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS done(path TEXT PRIMARY KEY, size INT, mtime INT, out TEXT, ver TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS info(path TEXT, verbose INT, size INT, mtime INT, out TEXT, ver TEXT, PRIMARY KEY (path, verbose))')
+        self.db.commit()
+
+    # return the cached `chdman.exe create*` output path for `input_path` (or None if missing/stale)
+    def get_compress(self, input_path, st):
+        with self.lock:
+            row = self.db.execute('SELECT out FROM done WHERE path=? AND size=? AND mtime=? AND ver=?', (os.path.abspath(input_path), st.st_size, st.st_mtime_ns, self.chdman_version)).fetchone()
+        if row is None:
+            return None
+        return Path(row[0])
+
+    # record a successful `chdman.exe create*` run (committed right away, since compression jobs are slow to redo)
+    def put_compress(self, input_path, st, output_chd_path):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO done VALUES (?, ?, ?, ?, ?)', (os.path.abspath(input_path), st.st_size, st.st_mtime_ns, str(output_chd_path), self.chdman_version))
+            self.db.commit()
+
+    # return the cached parsed `chdman.exe info` output for `input_path` (or None if missing/stale)
+    def get_info(self, input_path, st, verbose):
+        with self.lock:
+            row = self.db.execute('SELECT out FROM info WHERE path=? AND verbose=? AND size=? AND mtime=? AND ver=?', (os.path.abspath(input_path), int(verbose), st.st_size, st.st_mtime_ns, self.chdman_version)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    # record the parsed `chdman.exe info` output for `input_path` (committed once in `close`)
+    def put_info(self, input_path, st, verbose, out):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO info VALUES (?, ?, ?, ?, ?, ?)', (os.path.abspath(input_path), int(verbose), st.st_size, st.st_mtime_ns, json.dumps(out), self.chdman_version))
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+# parse a CHD v5 header and its list of metadata entries directly (or None if it can't be parsed)
+def _read_chd_header(input_path):
+    try:
+        with open(input_path, 'rb') as f, mmap(f.fileno(), 0, access=ACCESS_READ) as mm:
+            if len(mm) < CHD_V5_HEADER_SIZE or mm[:8] != CHD_MAGIC:
+                return None
+            version = unpack_from('>I', mm, 12)[0]
+            if version != 5:
+                return None
+            compressors = unpack_from('>4I', mm, 16)
+            logical_bytes, map_offset, meta_offset, hunk_bytes, unit_bytes = unpack_from('>QQQII', mm, 32)
+            if hunk_bytes == 0 or unit_bytes == 0 or hunk_bytes % unit_bytes != 0: # chdman requires hunks to be whole units
+                return None
+            out = {
+                'version': version,
+                'compressors': [c.to_bytes(4, 'big').decode('ascii', errors='replace') for c in compressors if c != 0],
+                'logical_bytes': logical_bytes,
+                'hunk_bytes': hunk_bytes,
+                'unit_bytes': unit_bytes,
+                'raw_sha1': mm[64:84].hex(),
+                'sha1': mm[84:104].hex(),
+                'parent_sha1': mm[104:124].hex(),
+                'file_bytes': len(mm),
+                'metadata': [],
+            }
+
+            # walk the linked list of metadata entries: tag (4 bytes), flags (1 byte), length (3 bytes), next offset (8 bytes)
+            visited = set()
+            while meta_offset != 0 and meta_offset not in visited:
+                visited.add(meta_offset)
+                if meta_offset + CHD_METADATA_ENTRY_SIZE > len(mm):
+                    return None
+                flags_length, next_offset = unpack_from('>IQ', mm, meta_offset + 4)
+                out['metadata'].append((mm[meta_offset:meta_offset+4].decode('ascii', errors='replace'), flags_length & 0xFFFFFF))
+                meta_offset = next_offset
+            return out
+    except (OSError, ValueError): # ValueError: can't mmap an empty file
+        return None
+
+# read the first metadata tag with a known format (e.g. `CHT2`) directly from a CHD v5 header (or None if it can't be parsed)
+def _read_chd_tag(input_path):
+    header = _read_chd_header(input_path)
+    if header is not None:
+        for tag, length in header['metadata']:
+            tag = tag.strip().upper()
+            if tag in TAG_TO_FORMAT:
+                return tag
+    return None
+
+# build the (key, value) pairs of non-verbose `chdman.exe info` from a parsed CHD v5 header
+def _info_from_header(input_path, header):
+    logical_bytes = header['logical_bytes']
+    out = [
+        ['Input file', str(input_path)],
+        ['File Version', str(header['version'])],
+        ['Logical size', '{:,} bytes'.format(logical_bytes)],
+        ['Hunk Size', '{:,} bytes'.format(header['hunk_bytes'])],
+        ['Total Hunks', '{:,}'.format((logical_bytes + header['hunk_bytes'] - 1) // header['hunk_bytes'])],
+        ['Unit Size', '{:,} bytes'.format(header['unit_bytes'])],
+        ['Total Units', '{:,}'.format((logical_bytes + header['unit_bytes'] - 1) // header['unit_bytes'])],
+        ['Compression', ', '.join('%s (%s)' % (c, CODEC_NAMES.get(c, 'Unknown')) for c in header['compressors']) or 'none'],
+        ['CHD size', '{:,} bytes'.format(header['file_bytes'])],
+    ]
+    if len(header['compressors']) != 0 and logical_bytes != 0:
+        out.append(['Ratio', '%.1f%%' % (100 * header['file_bytes'] / logical_bytes)])
+    if header['sha1'].strip('0') != '': # chdman only prints the SHA1s when the overall SHA1 is set
+        out.append(['SHA1', header['sha1']])
+        out.append(['Data SHA1', header['raw_sha1']])
+    if header['parent_sha1'].strip('0') != '':
+        out.append(['Parent SHA1', header['parent_sha1']])
+    for index, (tag, length) in enumerate(header['metadata']): # chdman counts `Index` across all entries, not per tag
+        out.append(['Metadata', "Tag='%s'  Index=%d  Length=%d bytes" % (tag, index, length)])
+    return out
+
+# print a command (shell-quoted) unless `quiet` (dry runs always print)
+def _print_command(command, dryrun=False, quiet=False):
+    if dryrun or not quiet:
+        print(shlex.join(map(os.fspath, command)))
+
+# create a directory (and its parents) unless it's in `created_dirs`, the set of directories already created in this run
+def make_dirs(path, dryrun=False, created_dirs=None):
+    if created_dirs is not None:
+        if path in created_dirs:
+            return
+        created_dirs.add(path)
+    if dryrun:
+        _print_command(['mkdir', '-p', path], dryrun=True)
+    else:
+        path.mkdir(parents=True, exist_ok=True)
+
+# delete files (ignoring missing ones), in parallel since each delete can be a round trip on network drives
+def _delete_files(paths):
+    def _delete(path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+    if len(paths) == 1:
+        _delete(paths[0])
+    else:
+        with ThreadPoolExecutor(max_workers=min(DELETE_JOBS, len(paths))) as ex:
+            list(ex.map(_delete, paths))
+
+# determine the output file path for `input_path` inside of directory `output_dir` (replacing its extension with `ext`)
+def _output_file_path(input_path, output_dir, ext):
+    return output_dir / ('.'.join(input_path.name.split('.')[:-1]) + ext)
+
+# check whether `output_path` was already claimed by another input in this run (and claim it if not)
+def _is_duplicate_output(input_path, output_path, output_paths):
+    key = os.path.normcase(output_path)
+    if key in output_paths:
+        print("Skipping (output path already used by another input): %s" % input_path, file=sys.stderr)
+        return True
+    output_paths.add(key)
+    return False
+
+# start compressing a single disc image to `output_chd_path` (no input/output validation); returns the running job (or None if nothing was started)
+def _start_compress(input_path, output_chd_path, output_format='auto', chdman_path=None, dryrun=False, cache=None, quiet=False):
+    input_ext = input_path.suffix.lower()
+
+    # skip if this exact input was already compressed by this chdman version
+    input_stat = None
+    if cache is not None:
+        input_stat = input_path.stat()
+        if cache.get_compress(input_path, input_stat) == output_chd_path and output_chd_path.exists():
+            if not quiet:
+                print("Skipping (already compressed): %s" % input_path)
+            return None
+
+    # determine output CHD format (might need to make the logic more complex here)
+    if output_format == 'auto':
+        if input_ext in ('.cue', '.gdi'):
+            output_format = 'cd'
+        elif input_ext == '.iso': # assume all `.iso` files are DVD (even if size is below 783 MB); might want to change this in the future
+            output_format = 'dvd'
+        elif input_path.stat().st_size >= 783216000:
+            output_format = 'dvd'
+        else: # default to CD (seemingly most compatibility)
+            output_format = 'cd'
+
+    # start `chdman.exe` to compress
+    command = [chdman_path, CREATE_COMMANDS[output_format], '--input', str(input_path), '--output', str(output_chd_path)]
+    _print_command(command, dryrun=dryrun, quiet=quiet)
+    if dryrun:
+        return None
+    return (input_path, input_stat, output_chd_path, Popen(command, close_fds=POPEN_CLOSE_FDS))
+
+# wait for a compression job to finish, then update the cache and delete the input if it was successful
+def _finish_compress(job, delete_input=False, cache=None, quiet=False):
+    input_path, input_stat, output_chd_path, proc = job
+    if proc.wait() == 0:
+        if cache is not None:
+            cache.put_compress(input_path, input_stat, output_chd_path)
+        if delete_input:
+            victims = []
+            if input_path.suffix.lower() == '.cue':
+                input_dir = str(input_path.parent)
+                victims += [os.path.join(input_dir, m.group(1) or m.group(2)) for m in CUE_FILE_RE.finditer(input_path.read_text(errors='replace'))]
+            victims.append(str(input_path))
+            _delete_files(victims)
+    if not quiet:
+        print()
+
+# compress all disc image files in `input_dir` into CHD files in `output_dir`
+def run_compress_dir(input_dir, output_dir, output_format='auto', delete_input=False, chdman_path=None, dryrun=False, jobs=1, cache=None, quiet=False, created_dirs=None):
+    chdman_path = _chdman_path_str(chdman_path)
+
+    # check and create output directory once
+    if output_dir.suffix.lower() == '.chd':
+        raise ValueError("Input path was a directory, so output path must be a directory as well: %s" % output_dir)
+    if output_dir.is_file():
+        raise ValueError("Output file exists: %s" % output_dir)
+    make_dirs(output_dir, dryrun=dryrun, created_dirs=created_dirs)
+
+    # run `chdman.exe` on all disc image files, keeping up to `jobs` running at once (oldest is finished first)
+    running = deque()
+    output_paths = set() # inputs with the same name in different subfolders would write (and race on) the same output
+    try:
+        for p in _iter_files(input_dir, DISC_IMAGE_EXTS):
+            output_chd_path = _output_file_path(p, output_dir, '.chd')
+            if _is_duplicate_output(p, output_chd_path, output_paths):
+                continue
+            job = _start_compress(p, output_chd_path, output_format=output_format, chdman_path=chdman_path, dryrun=dryrun, cache=cache, quiet=quiet)
+            if job is not None:
+                running.append(job)
+                if len(running) >= jobs:
+                    _finish_compress(running.popleft(), delete_input=delete_input, cache=cache, quiet=quiet)
+    finally: # still wait on (and clean up after) jobs that are already running if something above failed
+        while len(running) != 0:
+            _finish_compress(running.popleft(), delete_input=delete_input, cache=cache, quiet=quiet)
+
 # compress
-def run_compress(input_path, output_path, output_format='auto', delete_input=False, chdman_path=DEFAULT_CHDMAN_PATH, dryrun=False):
-    # first check and handle input/output
-    input_ext = input_path.suffix.strip().lower()
-    if output_path.is_file():
-        raise ValueError("Output file exists: %s" % args.output)
-    if output_path.suffix.strip().lower() != '.chd':
-        if dryrun:
-            print('mkdir -p %s' % output_path)
-        else:
-            output_path.mkdir(parents=True, exist_ok=True)
+def run_compress(input_path, output_path, output_format='auto', delete_input=False, chdman_path=None, dryrun=False, jobs=1, cache=None, quiet=False, input_type=None, created_dirs=None):
+    if input_type is None:
+        input_type = _path_type(input_path)
 
     # input is a file, so run `chdman.exe` to compress to `.chd`
-    if input_path.is_file():
-        if input_ext not in DISC_IMAGE_EXTS:
+    if input_type == 'file':
+        chdman_path = _chdman_path_str(chdman_path)
+        if input_path.suffix.lower() not in DISC_IMAGE_EXTS:
             raise ValueError("Invalid input file extension: %s" % input_path)
+        if output_path.is_file():
+            raise ValueError("Output file exists: %s" % output_path)
 
         # determine output file path
-        if output_path.suffix.strip().lower() == '.chd':
+        if output_path.suffix.lower() == '.chd':
             output_chd_path = output_path
         else:
-            output_chd_path = (output_path / ('.'.join(input_path.name.split('.')[:-1]) + '.chd'))
-
-        # determine output CHD format (might need to make the logic more complex here)
-        if output_format == 'auto':
-            if input_ext in {'.cue', '.gdi'}:
-                output_format = 'cd'
-            elif input_path.stat().st_size >= 783216000: 
-                output_format = 'dvd'
-            elif input_ext == '.iso': # assume all `.iso` files are DVD (even if size is below 783 MB); might want to change this in the future
-                output_format = 'dvd'
-            else: # default to CD (seemingly most compatibility)
-                output_format = 'cd'
-
-        # run `chdman.exe` to compress
-        command = [chdman_path, 'create%s' % output_format, '--input', input_path, '--output', output_chd_path]
-        print(' '.join(str(x) for x in command))
-        if not dryrun:
-            proc = run(command)
-            if delete_input and proc.returncode == 0:
-                if input_ext == '.cue':
-                    for l in open(input_path):
-                        if l.startswith('FILE'):
-                            if '"' in l:
-                                fn = l.split('"')[1]
-                            else:
-                                fn = l.split()[1].strip()
-                            (input_path.parent / fn).unlink(missing_ok=True)
-                input_path.unlink(missing_ok=True)
-            print()
-
-    # input is a directory, so recurse on all disc image files
-    elif input_path.is_dir():
-        if output_path.suffix.strip().lower() == '.chd':
-            raise ValueError("Input path was a directory, so output path must be a directory as well: %s" % output_path)
-        for p in input_path.rglob('*.*'):
-            if p.is_file() and p.suffix.strip().lower() in DISC_IMAGE_EXTS:
-                run_compress(
-                    p,
-                    output_path,
-                    output_format=output_format,
-                    delete_input=delete_input,
-                    chdman_path=chdman_path,
-                    dryrun=dryrun,
-                )
+            make_dirs(output_path, dryrun=dryrun, created_dirs=created_dirs)
+            output_chd_path = _output_file_path(input_path, output_path, '.chd')
+        job = _start_compress(input_path, output_chd_path, output_format=output_format, chdman_path=chdman_path, dryrun=dryrun, cache=cache, quiet=quiet)
+        if job is not None:
+            _finish_compress(job, delete_input=delete_input, cache=cache, quiet=quiet)
+
+    # input is a directory, so compress all disc image files in it
+    elif input_type == 'dir':
+        run_compress_dir(
+            input_path,
+            output_path,
+            output_format=output_format,
+            delete_input=delete_input,
+            chdman_path=chdman_path,
+            dryrun=dryrun,
+            jobs=jobs,
+            cache=cache,
+            quiet=quiet,
+            created_dirs=created_dirs,
+        )
     else:
         raise ValueError("Input path not found: %s" % input_path)
 
+# infer the disc image format of a CHD file (e.g. `cd`)
+def _infer_format(input_path, chdman_path=None, quiet=False):
+    # read format from CHD header (fall back to `chdman.exe info` if it can't be parsed)
+    tag = _read_chd_tag(input_path)
+    if tag is not None:
+        return TAG_TO_FORMAT[tag]
+    output_format = None
+    command_info = [chdman_path, 'info', '--input', str(input_path)]
+    _print_command(command_info, quiet=quiet)
+    proc = Popen(command_info, stdout=PIPE, bufsize=PIPE_BUFFER_SIZE, close_fds=POPEN_CLOSE_FDS)
+    for line in proc.stdout:
+        m = METADATA_TAG_RE.match(line)
+        if m is not None:
+            tag = m.group(1).decode('ascii', errors='replace').strip().upper()
+            if tag in TAG_TO_FORMAT:
+                output_format = TAG_TO_FORMAT[tag]
+                break
+    proc.stdout.close()
+    proc.wait()
+    if output_format is None:
+        raise ValueError("Unable to infer image format: %s" % input_path)
+    return output_format
+
+# start decompressing a single CHD file of format `output_format` to `output_img_path` (no input/output validation); returns the running job (or None if nothing was started)
+def _start_decompress(input_path, output_img_path, output_format, chdman_path=None, dryrun=False, quiet=False):
+    command = [chdman_path, EXTRACT_COMMANDS[output_format], '--input', str(input_path), '--output', str(output_img_path)]
+    if output_format == 'cd':
+        command += ['--outputbin', str((output_img_path.parent / output_img_path.stem).with_suffix('.bin'))]
+    _print_command(command, dryrun=dryrun, quiet=quiet)
+    if dryrun:
+        return None
+    return (input_path, Popen(command, close_fds=POPEN_CLOSE_FDS))
+
+# wait for a decompression job to finish, then delete the input if it was successful
+def _finish_decompress(job, delete_input=False, quiet=False):
+    input_path, proc = job
+    if proc.wait() == 0 and delete_input:
+        input_path.unlink(missing_ok=True)
+    if not quiet:
+        print()
+
+# decompress all `.chd` files in `input_dir` into disc images in `output_dir`
+def run_decompress_dir(input_dir, output_dir, delete_input=False, chdman_path=None, dryrun=False, jobs=1, quiet=False, created_dirs=None):
+    chdman_path = _chdman_path_str(chdman_path)
+
+    # check and create output directory once
+    if output_dir.suffix.lower() in DISC_IMAGE_EXTS:
+        raise ValueError("Input path was a directory, so output path must be a directory as well: %s" % output_dir)
+    if output_dir.is_file():
+        raise ValueError("Output file exists: %s" % output_dir)
+    make_dirs(output_dir, dryrun=dryrun, created_dirs=created_dirs)
+
+    # run `chdman.exe` on all `.chd` files, keeping up to `jobs` running at once (oldest is finished first)
+    running = deque()
+    output_paths = set() # inputs with the same name in different subfolders would write (and race on) the same output
+    try:
+        for p in _iter_files(input_dir, CHD_EXTS):
+            output_format = _infer_format(p, chdman_path=chdman_path, quiet=quiet)
+            output_img_path = _output_file_path(p, output_dir, FORMAT_TO_EXT[output_format])
+            if _is_duplicate_output(p, output_img_path, output_paths):
+                continue
+            job = _start_decompress(p, output_img_path, output_format, chdman_path=chdman_path, dryrun=dryrun, quiet=quiet)
+            if job is not None:
+                running.append(job)
+                if len(running) >= jobs:
+                    _finish_decompress(running.popleft(), delete_input=delete_input, quiet=quiet)
+    finally: # still wait on (and clean up after) jobs that are already running if something above failed
+        while len(running) != 0:
+            _finish_decompress(running.popleft(), delete_input=delete_input, quiet=quiet)
+
 # decompress
-def run_decompress(input_path, output_path, delete_input=False, chdman_path=DEFAULT_CHDMAN_PATH, dryrun=False):
-    # first check and handle output
-    if output_path.is_file():
-        raise ValueError("Output file exists: %s" % args.output)
-    if output_path.suffix.strip().lower() not in DISC_IMAGE_EXTS:
-        if dryrun:
-            print('mkdir -p %s' % output_path)
-        else:
-            output_path.mkdir(parents=True, exist_ok=True)
+def run_decompress(input_path, output_path, delete_input=False, chdman_path=None, dryrun=False, jobs=1, quiet=False, input_type=None, created_dirs=None):
+    if input_type is None:
+        input_type = _path_type(input_path)
 
     # input is a file, so run `chdman.exe` to decompress a `.chd`
-    if input_path.is_file():
-        if input_path.suffix.strip().lower() != '.chd':
+    if input_type == 'file':
+        chdman_path = _chdman_path_str(chdman_path)
+        if input_path.suffix.lower() != '.chd':
             raise ValueError("Input file must be a CHD: %s" % input_path)
+        if output_path.is_file():
+            raise ValueError("Output file exists: %s" % output_path)
 
-        # infer output format from CHD
-        output_format = None
-        command_info = [chdman_path, 'info', '--input', input_path]
-        print(' '.join(str(x) for x in command_info))
-        proc = run(command_info, capture_output=True)
-        for line in proc.stdout.decode().splitlines():
-            if line.startswith('Metadata:'):
-                try:
-                    output_format = TAG_TO_FORMAT[line.split("Tag='")[1].split("'")[0].strip().upper()]
-                    break
-                except:
-                    pass
-        if output_format is None:
-            raise ValueError("Unable to infer image format: %s" % input_path)
-        output_path_ext = output_path.suffix.strip().lower()
-        if output_path_ext in DISC_IMAGE_EXTS:
-            if output_format == 'cd' and output_path_ext != '.cue':
+        # determine output file path
+        output_format = _infer_format(input_path, chdman_path=chdman_path, quiet=quiet)
+        output_ext = output_path.suffix.lower()
+        if output_ext in DISC_IMAGE_EXTS:
+            if output_format == 'cd' and output_ext != '.cue':
                 raise ValueError("Output file extension must be .cue when decompressing CD CHD files: %s" % input_path)
             output_img_path = output_path
         else:
-            output_img_path = (output_path / ('.'.join(input_path.name.split('.')[:-1]) + FORMAT_TO_EXT[output_format]))
-
-        # run `chdman.exe` to decompress
-        command = [chdman_path, 'extract%s' % output_format, '--input', input_path, '--output', output_img_path]
-        if output_format == 'cd':
-            command += ['--outputbin', (output_img_path.parent / output_img_path.stem).with_suffix('.bin')]
-        print(' '.join(str(x) for x in command))
-        if not dryrun:
-            proc = run(command)
-            if delete_input and proc.returncode == 0:
-                input_path.unlink(missing_ok=True)
-            print()
-
-    # input is a directory, so recurse on all `.chd` files
-    elif input_path.is_dir():
-        if output_path.suffix.strip().lower() in DISC_IMAGE_EXTS:
-            raise ValueError("Input path was a directory, so output path must be a directory as well: %s" % output_path)
-        for p in input_path.rglob('*.*'):
-            if p.is_file() and p.suffix.strip().lower() == '.chd':
-                run_decompress(
-                    p,
-                    output_path=output_path,
-                    delete_input=delete_input,
-                    chdman_path=chdman_path,
-                    dryrun=dryrun,
-                )
+            make_dirs(output_path, dryrun=dryrun, created_dirs=created_dirs)
+            output_img_path = _output_file_path(input_path, output_path, FORMAT_TO_EXT[output_format])
+        job = _start_decompress(input_path, output_img_path, output_format, chdman_path=chdman_path, dryrun=dryrun, quiet=quiet)
+        if job is not None:
+            _finish_decompress(job, delete_input=delete_input, quiet=quiet)
+
+    # input is a directory, so decompress all `.chd` files in it
+    elif input_type == 'dir':
+        run_decompress_dir(
+            input_path,
+            output_path,
+            delete_input=delete_input,
+            chdman_path=chdman_path,
+            dryrun=dryrun,
+            jobs=jobs,
+            quiet=quiet,
+            created_dirs=created_dirs,
+        )
     else:
         raise ValueError("Input path not found: %s" % input_path)
 
-# info
-def run_info(input_path, chdman_path=DEFAULT_CHDMAN_PATH, verbose=False, print_header=True, dryrun=False):
+# run `chdman.exe info` on a single CHD file and return its (key, value) pairs (or None if dry run or chdman failed)
+# (dry runs only print the `chdman.exe info` commands a real run would execute, and never return rows)
+def _info_one(input_path, chdman_path=None, verbose=False, dryrun=False, cache=None):
+    # non-verbose info only needs the CHD header, so skip `chdman.exe` if it can be parsed
+    if not verbose:
+        header = _read_chd_header(input_path)
+        if header is not None:
+            return None if dryrun else _info_from_header(input_path, header)
+    if cache is not None:
+        input_stat = input_path.stat()
+        out = cache.get_info(input_path, input_stat, verbose)
+        if out is not None:
+            return None if dryrun else out
+    command = [chdman_path, 'info', '--input', str(input_path)]
+    if verbose:
+        command.append('--verbose')
+    if dryrun:
+        with PRINT_LOCK:
+            _print_command(command, dryrun=dryrun)
+        return None
+    out = list()
+    with Popen(command, stdout=PIPE, bufsize=PIPE_BUFFER_SIZE, close_fds=POPEN_CLOSE_FDS) as proc:
+        for line in proc.stdout: # parse lines as chdman writes them
+            m = INFO_LINE_RE.match(line)
+            if m is not None:
+                out.append([m.group(1).decode(errors='replace'), m.group(2).decode(errors='replace')])
+    if proc.returncode != 0:
+        with PRINT_LOCK:
+            print("Skipping (chdman info failed with exit code %d): %s" % (proc.returncode, input_path), file=sys.stderr)
+        return None
+    if cache is not None:
+        cache.put_info(input_path, input_stat, verbose, out)
+    return out
+
+# map the (key, value) pairs of `chdman.exe info` to {(key, occurrence): value}, since keys like `Metadata` can repeat
+def _keyed_values(out):
+    counts = dict()
+    values = dict()
+    for k, v in out:
+        i = counts.get(k, 0)
+        counts[k] = i + 1
+        values[(k, i)] = v
+    return values
+
+# info (yields the rows of the table as they become available, starting with the header if `print_header`)
+def iter_info(input_path, chdman_path=None, verbose=False, print_header=True, dryrun=False, jobs=1, cache=None, input_type=None):
+    chdman_path = _chdman_path_str(chdman_path)
+    if input_type is None:
+        input_type = _path_type(input_path)
+
     # input is a file, so run `chdman.exe info` on it
-    if input_path.is_file():
-        if input_path.suffix.strip().lower() != '.chd':
+    if input_type == 'file':
+        if input_path.suffix.lower() != '.chd':
             raise ValueError("Input file must be CHD: %s" % input_path)
-        command = [chdman_path, 'info', '--input', input_path]
-        if verbose:
-            command.append('--verbose')
-        if dryrun:
-            print(' '.join(str(x) for x in command))
-        else:
-            proc = run(command, capture_output=True)
-            out = [[v.strip() for v in l.split(':')] for l in proc.stdout.decode().splitlines() if ': ' in l]
+        out = _info_one(input_path, chdman_path=chdman_path, verbose=verbose, dryrun=dryrun, cache=cache)
+        if out is not None:
             if print_header:
-                print('\t'.join(k for k,v in out))
-            print('\t'.join(v for k,v in out))
-
-    # input is a directory, so recurse on all `.chd` files
-    elif input_path.is_dir():
-        count = 0
-        for p in input_path.rglob('*.*'):
-            if p.is_file() and p.suffix.strip().lower() == '.chd':
-                run_info(
-                    p,
-                    chdman_path=chdman_path,
-                    verbose=verbose,
-                    print_header=(count == 0),
-                    dryrun=dryrun,
-                )
-                count += 1
+                yield [k for k,v in out]
+            yield [v for k,v in out]
+
+    # input is a directory, so run `chdman.exe info` on all `.chd` files in parallel and yield the table (in sorted path order) from here
+    elif input_type == 'dir':
+        paths = sorted(_iter_files(input_path, CHD_EXTS))
+        with ThreadPoolExecutor(max_workers=jobs) as ex:
+            columns = None # (key, occurrence) columns of the first file, which all other rows are aligned to
+            for p, out in zip(paths, ex.map(lambda p: _info_one(p, chdman_path=chdman_path, verbose=verbose, dryrun=dryrun, cache=cache), paths)):
+                if out is not None:
+                    values = _keyed_values(out)
+                    if columns is None:
+                        columns = list(values)
+                        if print_header:
+                            yield [k for k,i in columns]
+                    else:
+                        # rows are streamed, so columns the first file didn't have are appended to the end of the table (and reported)
+                        new_columns = [c for c in values if c not in columns]
+                        if len(new_columns) != 0:
+                            columns += new_columns
+                            with PRINT_LOCK:
+                                print("Appending columns not in the header (first seen in %s): %s" % (p, ', '.join(k for k,i in new_columns)), file=sys.stderr)
+                    yield [values.get(c, '') for c in columns]
     else:
         raise ValueError("Input path not found: %s" % input_path)
 
+# info (returns the rows of the table, starting with the header if `print_header`)
+def run_info(input_path, chdman_path=None, verbose=False, print_header=True, dryrun=False, jobs=1, cache=None, input_type=None):
+    return list(iter_info(input_path, chdman_path=chdman_path, verbose=verbose, print_header=print_header, dryrun=dryrun, jobs=jobs, cache=cache, input_type=input_type))
+
 # main program logic
 def main():
-    args = parse_args()
-    if args.command == 'compress':
-        run_compress(
-            input_path=args.input,
-            output_path=args.output,
-            output_format=args.format,
-            delete_input=args.delete_input,
-            chdman_path=args.chdman_path,
-            dryrun=args.dryrun,
-        )
-    elif args.command == 'decompress':
-        run_decompress(
-            input_path=args.input,
-            output_path=args.output,
-            delete_input=args.delete_input,
-            chdman_path=args.chdman_path,
-            dryrun=args.dryrun,
-        )
-    elif args.command == 'info':
-        run_info(
-            input_path=args.input,
-            chdman_path=args.chdman_path,
-            verbose=args.verbose,
-            dryrun=args.dryrun,
-        )
-    else:
-        raise ValueError("Invalid command: %s" % args.command)
+    args = _parse_info_args_fast(sys.argv[1:])
+    if args is None:
+        args = parse_args()
+    cache = None
+    if args.cache_file is not None:
+        cache = JobCache(args.cache_file, get_chdman_version(args.chdman_path))
+    created_dirs = set() # output directories already created in this run (so they're only created once)
+    try:
+        if args.command == 'compress':
+            if args.output.suffix.lower() != '.chd':
+                make_dirs(args.output, dryrun=args.dryrun, created_dirs=created_dirs)
+            run_compress(
+                input_path=args.input,
+                input_type=args.input_type,
+                output_path=args.output,
+                output_format=args.format,
+                delete_input=args.delete_input,
+                chdman_path=args.chdman_path,
+                dryrun=args.dryrun,
+                jobs=args.jobs,
+                cache=cache,
+                quiet=args.quiet,
+                created_dirs=created_dirs,
+            )
+        elif args.command == 'decompress':
+            if args.output.suffix.lower() not in DISC_IMAGE_EXTS:
+                make_dirs(args.output, dryrun=args.dryrun, created_dirs=created_dirs)
+            run_decompress(
+                input_path=args.input,
+                input_type=args.input_type,
+                output_path=args.output,
+                delete_input=args.delete_input,
+                chdman_path=args.chdman_path,
+                dryrun=args.dryrun,
+                jobs=args.jobs,
+                quiet=args.quiet,
+                created_dirs=created_dirs,
+            )
+        elif args.command == 'info':
+            rows = iter_info(
+                input_path=args.input,
+                input_type=args.input_type,
+                chdman_path=args.chdman_path,
+                verbose=args.verbose,
+                dryrun=args.dryrun,
+                jobs=args.jobs,
+                cache=cache,
+            )
+            out = sys.stdout
+            out.writelines('\t'.join(row) + '\n' for row in rows)
+            out.flush()
+        else:
+            raise ValueError("Invalid command: %s" % args.command)
+    finally:
+        if cache is not None:
+            cache.close()
 
 # run program
 if __name__ == "__main__":